@@ -2,11 +2,19 @@ import asyncio
 import threading
 import tempfile
 import os
-from queue import Queue, Empty
+from concurrent.futures import Future
+from functools import partial
+from collections import deque
 import customtkinter as ctk
 
-from bleak import BleakScanner
-from pybricksdev.connections.pybricks import PybricksHubBLE
+# uvloop (Linux/macOS) o winloop (Windows) son opcionales: loop asyncio más rápido para el worker BLE
+try:
+    import uvloop as fast_loop
+except ImportError:
+    try:
+        import winloop as fast_loop
+    except ImportError:
+        fast_loop = None
 
 # ==============================================================================
 # 1. CÓDIGO DEL FIRMWARE (Lógica del Robot - Gateway)
@@ -15,7 +23,6 @@ HUB_GATEWAY_CODE = """
 from pybricks.hubs import PrimeHub
 from pybricks.pupdevices import Motor
 from pybricks.parameters import Port
-from pybricks.tools import wait
 import uselect
 import usys
 
@@ -28,53 +35,141 @@ poll = uselect.poll()
 poll.register(usys.stdin, uselect.POLLIN)
 
 hub.display.char('G')
-
+# Aviso por stdout de que el gateway está listo para recibir comandos
+print('G')
+
+def forward():
+    motorB.run(-1100)
+    motorF.run(1100)
+
+def backward():
+    motorB.run(800)
+    motorF.run(-800)
+
+def center():
+    motorD.run_target(500, 0, wait=True)
+    motorD.stop()
+
+def stop():
+    motorB.stop()
+    motorF.stop()
+
+def shutdown():
+    motorB.stop()
+    motorF.stop()
+    motorD.stop()
+    raise SystemExit
+
+# Tabla de comandos: una búsqueda en vez de una cadena de if/elif
+DISPATCH = {
+    'F': forward,
+    'T': forward,
+    'B': backward,
+    'L': lambda: motorD.run_target(500, -25, wait=False),
+    'R': lambda: motorD.run_target(500, 25, wait=False),
+    'C': center,
+    'S': stop,
+    'X': shutdown,
+}
+
+# poll() sin timeout bloquea hasta que llega un byte; el firmware sigue
+# atendiendo los motores en segundo plano mientras espera
 while True:
-    if poll.poll(10):
-        cmd = usys.stdin.read(1)
-        if cmd == 'F':
-            motorB.run(-1100)
-            motorF.run(1100)
-        elif cmd == 'T':
-            motorB.run(-1100)
-            motorF.run(1100)
-        elif cmd == 'B':
-            motorB.run(800)
-            motorF.run(-800)
-        elif cmd == 'L':
-            motorD.run_target(500, -25, wait=False)
-        elif cmd == 'R':
-            motorD.run_target(500, 25, wait=False)
-        elif cmd == 'C':
-            motorD.run_target(500, 0, wait=True)
-            motorD.stop()
-        elif cmd == 'S':
-            motorB.stop()
-            motorF.stop()
-        elif cmd == 'X':
-            motorB.stop()
-            motorF.stop()
-            motorD.stop()
-            raise SystemExit
-    wait(10)
+    poll.poll()
+    fn = DISPATCH.get(usys.stdin.read(1))
+    if fn:
+        fn()
 """
+
+# ABI de MicroPython de los Hubs con Pybricks >= 3.2 (el .mpy es el mismo para v6 y v6.1)
+GATEWAY_ABI = 6
+
+# Carpeta en RAM para el .py temporal del gateway cuando existe (Linux); si no, la de siempre
+GATEWAY_TMP_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+def _write_gateway_file(directory):
+    """Escribe el firmware gateway en la carpeta dada (mpy-cross necesita un archivo)"""
+    path = os.path.join(directory, "lego_gateway.py")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(HUB_GATEWAY_CODE)
+    return path
+
 # ==============================================================================
 # 2. WORKER BLE (Gestor de Comunicación en Segundo Plano)
 # ==============================================================================
-# Importar la excepción específica para poder ignorarla
-from pybricksdev.connections.pybricks import HubDisconnectError 
+def _import_ble():
+    """Importa bleak y pybricksdev recién al escanear/conectar, para que la ventana aparezca antes"""
+    global BleakScanner, PybricksHubBLE, HubDisconnectError, compile_multi_file
+    global Command, HubCapabilityFlag, PYBRICKS_COMMAND_EVENT_UUID, PYBRICKS_SERVICE_UUID
+    global ConnectionState
+    from bleak import BleakScanner
+    from pybricksdev.connections import ConnectionState
+    from pybricksdev.connections.pybricks import PybricksHubBLE
+    # Importar la excepción específica para poder ignorarla
+    from pybricksdev.connections.pybricks import HubDisconnectError
+    from pybricksdev.ble.pybricks import (
+        Command, HubCapabilityFlag, PYBRICKS_COMMAND_EVENT_UUID, PYBRICKS_SERVICE_UUID
+    )
+    from pybricksdev.compile import compile_multi_file
+
+# Ventana para juntar comandos en una sola escritura (~1 intervalo de conexión BLE mínimo)
+BATCH_WINDOW = 0.015
+
+# Intervalo de conexión BLE en Linux (BlueZ vía debugfs, unidades de 1.25 ms): 7.5 - 15 ms
+BLUEZ_DEBUGFS = "/sys/kernel/debug/bluetooth/hci0"
+CONN_MIN_INTERVAL = 6
+CONN_MAX_INTERVAL = 12
+
+# Tiempo máximo (s) para que el gateway compile, se descargue y avise que está listo
+HUB_READY_TIMEOUT = 10
+
+# Tras "DESCONECTAR" el enlace BLE queda abierto este tiempo (s) por si se vuelve a conectar
+IDLE_DISCONNECT_TIMEOUT = 60
 
 class BLEWorker:
-    def __init__(self, log_queue: Queue):
-        self.loop = asyncio.new_event_loop()
-        self.thread = threading.Thread(target=self._thread_main, daemon=True)
-        self.queue = None
+    # Canal de cada comando: en un mismo canal solo importa el más reciente
+    CMD_CHANNEL = {
+        'F': 'traccion', 'B': 'traccion', 'T': 'traccion', 'S': 'traccion',
+        'L': 'direccion', 'R': 'direccion', 'C': 'direccion',
+        'X': 'control'
+    }
+    # Comandos que fijan un estado: repetirlos no cambia nada. 'C' no entra: el gateway
+    # deja el motor de dirección libre tras centrar y puede hacer falta volver a centrar
+    STATE_CMDS = frozenset("FBTSLR")
+    # Bytes ya codificados de cada comando (evita un encode() por envío)
+    _ENCODED = {c: c.encode() for c in "FBLRCTSX"}
+
+    def __init__(self, log_queue: deque, on_log=None):
+        self.loop = fast_loop.new_event_loop() if fast_loop else asyncio.new_event_loop()
+        # El hilo del loop solo vive mientras haya trabajos (sesión o escaneo) pendientes
+        self.thread = None
+        self._jobs = 0
+        self._jobs_lock = threading.Lock()
+        self._pending_cmds = {}
+        self._cmd_event = None
         self.hub = None
-        self.running = threading.Event()
+        # Bandera simple (lectura atómica con el GIL): la GUI la consulta en cada tecla
+        self.connected = False
         self.log_queue = log_queue
-        self._target_device = None
-        self._connect_request = asyncio.Event()
+        # Aviso (desde el hilo BLE) de que hay mensajes nuevos para la GUI
+        self.on_log = on_log
+        self._session = None
+        # Tarea asyncio de la sesión y su Future de "listo" (para abortar al cerrar la app)
+        self._session_task = None
+        self._ready = None
+        # Control liberado pero enlace BLE abierto (ver pause)
+        self._paused = False
+        # El Hub se apagó, se alejó o terminó el gateway: la sesión debe cerrarse (ver _mark_link_lost)
+        self._link_lost = False
+        self._device = None
+        # Nombre resuelto durante el escaneo (device.name puede venir vacío)
+        self._device_name = None
+        self._scanner = None
+        # Tareas de compilación del gateway (.mpy) por ABI: se compila una sola vez por ejecución
+        self._gateway_mpy = {}
         self.run_task = None 
+        # Último comando enviado por canal (para no repetir bytes idénticos por BLE)
+        self._last_cmd = {}
 
         # Diccionario para traducir letras a texto legible en el Log
         self.CMD_DESC = {
@@ -87,115 +182,387 @@ class BLEWorker:
             'S': "Deteniendo Motores",
             'X': "Desconexión"
         }
+        # Entradas de log ya armadas para cada comando (no se formatean en cada envío)
+        self._action_log = {c: ("log", f"Acción: {d}") for c, d in self.CMD_DESC.items()}
+
+    def _post(self, entry):
+        self.log_queue.append(entry)
+        if self.on_log:
+            self.on_log()
 
     def log(self, msg):
-        self.log_queue.put(msg)
+        self._post(("log", msg))
+
+    def _signal(self, kind, msg):
+        """Avisa a la GUI un cambio de estado ("disconnected") junto con su texto"""
+        self._post((kind, msg))
+
+    def _tune_conn_params(self):
+        """Pide a BlueZ un intervalo de conexión corto (solo Linux, requiere root)"""
+        try:
+            # Primero el mínimo: el kernel exige min <= max en cada escritura
+            for name, value in (("conn_min_interval", CONN_MIN_INTERVAL),
+                                ("conn_max_interval", CONN_MAX_INTERVAL)):
+                with open(os.path.join(BLUEZ_DEBUGFS, name), "wb") as f:
+                    f.write(f"{value}\n".encode())
+        except OSError:
+            # Sin permisos o sin debugfs (Windows/macOS): se usa el intervalo por defecto
+            return
+        self.log("Intervalo de conexión BLE ajustado.")
+
+    async def fast_write(self, data):
+        """Escribe en el stdin del Hub sin esperar la respuesta ATT (write-without-response)"""
+        await self.hub.write_gatt_char(PYBRICKS_COMMAND_EVENT_UUID, self._stdin_prefix + data, False)
+
+    async def scan(self, on_found, on_name=None, timeout=2.5):
+        """Escanea Hubs Pybricks y llama a on_found(device, name) apenas aparece cada uno.
+        Si el nombre llega en un anuncio posterior (scan response), avisa con on_name(device, name)"""
+        if self._scanner is None:
+            _import_ble()
+            # El filtro por servicio Pybricks lo aplica el sistema operativo, no Python
+            self._scanner = BleakScanner(service_uuids=[PYBRICKS_SERVICE_UUID], scanning_mode="active")
+
+        # Dirección -> nombre conocido; el nombre se resuelve aquí y no en el hilo de Tk
+        seen = {}
+
+        async def collect():
+            async for device, adv in self._scanner.advertisement_data():
+                name = adv.local_name or device.name
+                if device.address not in seen:
+                    seen[device.address] = name
+                    on_found(device, name)
+                elif name and not seen[device.address]:
+                    seen[device.address] = name
+                    if on_name:
+                        on_name(device, name)
+
+        async with self._scanner:
+            try:
+                await asyncio.wait_for(collect(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _compile_gateway(self, abi):
+        # Solo se toca el disco al compilar: luego se reutilizan los bytes en memoria
+        with tempfile.TemporaryDirectory(dir=GATEWAY_TMP_DIR) as tmp:
+            return await compile_multi_file(_write_gateway_file(tmp), abi)
+
+    def _gateway_mpy_for(self, abi):
+        """Tarea (compartida entre conexiones) que compila el gateway para la ABI dada"""
+        task = self._gateway_mpy.get(abi)
+        if task is None or (task.done() and (task.cancelled() or task.exception())):
+            task = asyncio.ensure_future(self._compile_gateway(abi))
+            self._gateway_mpy[abi] = task
+        return task
+
+    async def _run_gateway(self):
+        """Descarga el gateway precompilado y lo ejecuta en el Hub"""
+        if self.hub._mpy_abi_version:
+            # Firmware antiguo: pybricksdev solo sabe cargarlo desde el .py
+            with tempfile.TemporaryDirectory(dir=GATEWAY_TMP_DIR) as tmp:
+                await self.hub.run(_write_gateway_file(tmp))
+            return
+
+        supported = (HubCapabilityFlag.USER_PROG_MULTI_FILE_MPY6
+                     | HubCapabilityFlag.USER_PROG_MULTI_FILE_MPY6_1_NATIVE)
+        if not self.hub._capability_flags & supported:
+            raise RuntimeError("El Hub no acepta programas MPY v6")
+
+        # shield: si se cancela la sesión, la compilación compartida sigue viva
+        mpy = await asyncio.shield(self._gateway_mpy_for(GATEWAY_ABI))
+        await self.hub.download_user_program(mpy)
+        # Sin ruta, run() ejecuta el programa que acabamos de descargar
+        await self.hub.run()
 
     def _thread_main(self):
         asyncio.set_event_loop(self.loop)
-        self.loop.create_task(self._runner())
-        self.loop.run_forever()
-
-    async def _runner(self):
-        temp_path = None
         while True:
-            await self._connect_request.wait()
+            self.loop.run_forever()
+            # El propio hilo decide si termina: si llegó trabajo nuevo mientras se
+            # detenía el loop, vuelve a correrlo (nadie tiene que esperarlo con join)
+            with self._jobs_lock:
+                if self._jobs == 0:
+                    self.thread = None
+                    return
+
+    def submit(self, coro):
+        """Ejecuta una corrutina en el loop del worker, levantando su hilo solo si hace falta"""
+        with self._jobs_lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._thread_main, daemon=True)
+                self.thread.start()
+            self._jobs += 1
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        future.add_done_callback(self._job_done)
+        return future
+
+    def _job_done(self, future):
+        with self._jobs_lock:
+            self._jobs -= 1
+            if self._jobs == 0:
+                # Sin trabajo pendiente: detenemos el loop; _thread_main decide si el hilo termina
+                self.loop.call_soon_threadsafe(self.loop.stop)
+
+    async def _do_connect(self, device, name, ready):
+        """Sesión completa con un Hub: conecta, carga el gateway y envía comandos hasta desconectar"""
+        self._device = device
+        self._device_name = name
+        self._session_task = asyncio.current_task()
+        self._link_lost = False
+        state_sub = None
+        try:
+            # Dentro del try: si faltan las librerías BLE, el finally avisa a la GUI igual
+            _import_ble()
+            self._stdin_prefix = bytes([Command.WRITE_STDIN])
+            self.log(f"Conectando a {name or device.address}...")
+            self._tune_conn_params()
+            self.hub = PybricksHubBLE(device)
+            # Compilamos el gateway mientras se negocia la conexión BLE
+            self._gateway_mpy_for(GATEWAY_ABI)
+            await self.hub.connect()
+            # Si el enlace cae (Hub apagado o fuera de alcance) el escritor se entera al instante
+            state_sub = self.hub.connection_state_observable.subscribe(
+                lambda state: state == ConnectionState.DISCONNECTED and self._mark_link_lost()
+            )
+
+            self.log("Cargando firmware gateway...")
+            self._pending_cmds = {}
+            self._cmd_event = asyncio.Event()
+            self._last_cmd = {}
             
+            # El gateway imprime la línea "G" al arrancar: ese es el aviso de "listo".
+            # Cualquier otra salida (p. ej. un traceback si falta un motor) no cuenta
+            hub_ready = asyncio.Event()
+            stdout_buf = bytearray()
+
+            def on_stdout(data):
+                stdout_buf.extend(data)
+                if b"G" in stdout_buf.splitlines():
+                    hub_ready.set()
+
+            ready_sub = self.hub.stdout_observable.subscribe(on_stdout)
+
+            # Guardamos la tarea en self.run_task para poder cancelarla limpiamente luego
+            self.run_task = asyncio.create_task(self._run_gateway())
+            # Si el gateway termina (botón del Hub, error o desconexión) la sesión ya no sirve
+            self.run_task.add_done_callback(self._mark_link_lost)
+            
+            ready_wait = asyncio.ensure_future(hub_ready.wait())
             try:
-                if not self._target_device:
-                    self._connect_request.clear()
-                    continue
-
-                self.log(f"Conectando a {self._target_device.name}...")
-                self.hub = PybricksHubBLE(self._target_device)
-                await self.hub.connect()
-
-                self.log("Cargando firmware gateway...")
-                with tempfile.NamedTemporaryFile(mode='w', suffix='.py', delete=False) as tf:
-                    tf.write(HUB_GATEWAY_CODE)
-                    temp_path = tf.name
-
-                self.queue = asyncio.Queue()
-                
-                # Guardamos la tarea en self.run_task para poder cancelarla limpiamente luego
-                self.run_task = asyncio.create_task(self.hub.run(temp_path))
-                
-                await asyncio.sleep(1) 
-                self.running.set()
-                self.log("¡CONEXIÓN ESTABLECIDA!") 
-
-                while self.running.is_set():
+                await asyncio.wait({ready_wait, self.run_task}, timeout=HUB_READY_TIMEOUT,
+                                   return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                ready_wait.cancel()
+                ready_sub.dispose()
+            if not hub_ready.is_set():
+                if self.run_task.done():
+                    # Propaga el error de carga (compilación, desconexión...)
+                    self.run_task.result()
+                raise RuntimeError("El Hub no confirmó el arranque del gateway")
+            self.connected = True
+            self.log("¡CONEXIÓN ESTABLECIDA!")
+            # shutdown() pudo cancelar el aviso mientras conectábamos
+            if not ready.done():
+                ready.set_result(True)
+
+            # Las decisiones que no cambian durante la sesión se toman una vez, fuera del bucle:
+            # el firmware antiguo usa NUS, cuyo hub.write ya es sin respuesta
+            hub = self.hub
+            write_fast = hub.write if hub._legacy_stdio else self.fast_write
+
+            while True:
+                try:
+                    # En pausa nadie manda comandos: si pasa el tiempo, cerramos el enlace de verdad
+                    timeout = None if self.connected else IDLE_DISCONNECT_TIMEOUT
                     try:
-                        cmd = await self.queue.get()
-                        if self.hub: 
-                            await self.hub.write(cmd.encode())
-                    except asyncio.CancelledError:
-                        break 
-                    except Exception as e:
-                        if "disconnected" in str(e):
-                            break
-                        self.log(f"Error enviando: {e}")
-
-            except HubDisconnectError:
-                # Ignoramos el error de desconexión normal
+                        await asyncio.wait_for(self._cmd_event.wait(), timeout)
+                    except asyncio.TimeoutError:
+                        self.log("Enlace BLE inactivo: desconectando.")
+                        # Si el enlace ya había caído la escritura falla: igual se cierra la sesión
+                        try: await hub.write(self._ENCODED['X'])
+                        except Exception: pass
+                        break
+                    if self._link_lost:
+                        self.log("Se perdió el enlace con el Hub.")
+                        break
+                    # Esperamos un intervalo para juntar ráfagas en un solo paquete
+                    await asyncio.sleep(BATCH_WINDOW)
+                    # Tomamos solo el último comando de cada canal (los anteriores ya no valen)
+                    data = b"".join(self._pending_cmds.values())
+                    self._pending_cmds.clear()
+                    self._cmd_event.clear()
+                    # El firmware lee de a un carácter, así que varios bytes juntos se procesan bien
+                    if b'X' in data:
+                        # La desconexión sí necesita confirmación del Hub
+                        await hub.write(data)
+                        break
+                    if data:
+                        await write_fast(data)
+                except asyncio.CancelledError:
+                    break 
+                except Exception as e:
+                    if self._link_lost or "disconnected" in str(e):
+                        break
+                    self.log(f"Error enviando: {e}")
+
+        except ImportError as e:
+            # Va antes que HubDisconnectError: si falló la importación, ese nombre no existe
+            self.log(f"Faltan librerías BLE (bleak/pybricksdev): {e}")
+        except HubDisconnectError:
+            # Ignoramos el error de desconexión normal
+            pass
+        except Exception as e:
+            self.log(f"Error general: {e}")
+        finally:
+            if state_sub:
+                state_sub.dispose()
+            # Cancelar la tarea que corre el programa en el hub si sigue viva
+            if self.run_task and not self.run_task.done():
+                self.run_task.cancel()
+                try: await self.run_task
+                except: pass 
+            
+            if self.hub:
+                try: await self.hub.disconnect()
+                except: pass
+            
+            self.connected = False
+            self._paused = False
+            self._cmd_event = None
+            self.run_task = None
+            self.hub = None
+            if not ready.done():
+                ready.set_result(False)
+            self._signal("disconnected", "Sistema Desconectado.")
+
+    async def _switch_device(self, old_session, device, name, ready):
+        # Espera a que cierre la sesión en pausa con el otro Hub y conecta al nuevo
+        self._session_task = asyncio.current_task()
+        await asyncio.wrap_future(old_session)
+        await self._do_connect(device, name, ready)
+
+    def connect_to_device(self, device, name=None):
+        """Inicia la sesión; devuelve un Future que se resuelve True al quedar listo (False si falla)"""
+        ready = Future()
+        self._ready = ready
+        if self._session and not self._session.done():
+            if not self._paused:
+                # Una sola sesión a la vez (el botón sigue activo mientras se conecta)
+                self.log("Ya hay una conexión en curso.")
+                return None
+            if device.address == self._device.address and not self._link_lost:
+                # Mismo Hub con el enlace aún abierto: se retoma sin reconectar
+                self._resume()
+                ready.set_result(True)
+                return ready
+            # Otro Hub (o el mismo con el enlace caído): se cierra la sesión en pausa antes de conectar
+            old_session = self._session
+            self.stop_connection()
+            self._session = self.submit(self._switch_device(old_session, device, name, ready))
+            return ready
+        self._session = self.submit(self._do_connect(device, name, ready))
+        return ready
+
+    def pause(self):
+        """Libera el control y frena, pero deja el enlace BLE abierto por si se vuelve a conectar"""
+        if not self.connected:
+            return
+        self.connected = False
+        self._paused = True
+        # 'S' frena la tracción y despierta al escritor para que arme el temporizador de inactividad
+        self.loop.call_soon_threadsafe(self._set_pending, "S")
+        self.log(f"Control liberado (enlace BLE abierto {IDLE_DISCONNECT_TIMEOUT} s).")
+
+    def _resume(self):
+        self._paused = False
+        self._last_cmd = {}
+        self.connected = True
+        # Despertamos al escritor para que deje de contar el tiempo de inactividad
+        self.loop.call_soon_threadsafe(self._wake_writer)
+        self.log("¡CONEXIÓN ESTABLECIDA! (enlace reutilizado)")
+
+    @property
+    def paused_device(self):
+        """(device, nombre) del Hub con el enlace abierto en pausa (conectado no anuncia, no sale en el escaneo)"""
+        if self._paused and not self._link_lost:
+            return self._device, self._device_name
+        return None
+
+    def shutdown(self, timeout=2.0):
+        """Cierra de verdad la sesión (al salir de la app) y espera a que termine"""
+        session = self._session
+        if session and not session.done():
+            # Tk queda bloqueado esperando: el worker no debe llamarlo (ni logs ni el aviso de
+            # "listo", que cancelamos aquí para que sus callbacks corran en este hilo)
+            self.on_log = None
+            if self._ready:
+                self._ready.cancel()
+            if self.connected or self._paused:
+                self.stop_connection()
+            else:
+                # Todavía conectando: no hay escritor que reciba la 'X', se aborta la sesión
+                self.loop.call_soon_threadsafe(self._abort_session)
+            try:
+                session.result(timeout)
+            except Exception:
                 pass
-            except Exception as e:
-                self.log(f"Error general: {e}")
-            finally:
-                # Limpieza de archivo temporal
-                if temp_path and os.path.exists(temp_path):
-                    try: os.unlink(temp_path)
-                    except: pass
-                
-                # Cancelar la tarea que corre el programa en el hub si sigue viva
-                if self.run_task and not self.run_task.done():
-                    self.run_task.cancel()
-                    try: await self.run_task
-                    except: pass 
-                
-                if self.hub:
-                    try: await self.hub.disconnect()
-                    except: pass
-                
-                self.running.clear()
-                self._connect_request.clear()
-                self._target_device = None
-                self.hub = None
-                self.log("Sistema Desconectado.")
-
-    def start(self):
-        if not self.thread.is_alive():
-            self.thread.start()
-
-    def connect_to_device(self, device):
-        self._target_device = device
-        self.loop.call_soon_threadsafe(self._connect_request.set)
+
+    def _abort_session(self):
+        if self._session_task:
+            self._session_task.cancel()
+
+    def _mark_link_lost(self, *_):
+        self._link_lost = True
+        self._wake_writer()
+
+    def _wake_writer(self):
+        if self._cmd_event is not None:
+            self._cmd_event.set()
+
+    def _set_pending(self, char):
+        # Se ejecuta dentro del loop asyncio: reemplaza el comando pendiente del canal
+        if self._cmd_event is None:
+            return
+        self._pending_cmds[self.CMD_CHANNEL.get(char, char)] = self._ENCODED.get(char) or char.encode()
+        self._cmd_event.set()
 
     def send_command(self, char):
-        if self.running.is_set() and self.queue:
+        if self.connected and self._cmd_event:
+            # Tracción y dirección son estados: repetir el del canal no cambia nada
+            channel = self.CMD_CHANNEL.get(char, char)
+            if char in self.STATE_CMDS and self._last_cmd.get(channel) == char:
+                return
+            self._last_cmd[channel] = char
+
             # 1. Enviar el comando al loop asyncio
-            self.loop.call_soon_threadsafe(self.queue.put_nowait, char)
+            self.loop.call_soon_threadsafe(self._set_pending, char)
             
             # 2. Traducir y mostrar en GUI
-            desc = self.CMD_DESC.get(char, f"Comando: {char}")
-            # Evitamos spamear el log si es solo soltar tecla (Stop), opcionalmente
-            self.log(f"Acción: {desc}")
+            entry = self._action_log.get(char)
+            if entry:
+                self._post(entry)
+            else:
+                self.log(f"Acción: Comando: {char}")
 
     def stop_connection(self):
-        self.running.clear()
+        self.connected = False
+        self._paused = False
         # Enviamos 'X' para que el Hub se apague solo antes de cortar el Bluetooth
-        if self.queue:
-            self.loop.call_soon_threadsafe(self.queue.put_nowait, "X")
+        if self._cmd_event:
+            self.loop.call_soon_threadsafe(self._set_pending, "X")
 # ===================================================================
 # 3. VENTANA DE SELECCIÓN 
 # ===================================================================
 class DeviceSelectWindow(ctk.CTkToplevel):
-    def __init__(self, parent, callback):
+    def __init__(self, parent, worker, callback):
         super().__init__(parent)
+        self.worker = worker
         self.callback = callback
         self.title("Buscar HUB LEGO")
         self.geometry("400x400")
         self.attributes("-topmost", True)
+        # Cerrar solo oculta la ventana: se reutiliza (con sus botones) en el próximo escaneo
+        self.protocol("WM_DELETE_WINDOW", self._hide)
         self.grab_set()
 
         self.lbl = ctk.CTkLabel(self, text="Escaneando dispositivos BLE...", font=("Arial", 14))
@@ -204,35 +571,95 @@ class DeviceSelectWindow(ctk.CTkToplevel):
         self.scroll = ctk.CTkScrollableFrame(self)
         self.scroll.pack(expand=True, fill="both", padx=10, pady=10)
 
-        threading.Thread(target=self._scan, daemon=True).start()
+        # Pool de botones: se reconfiguran en vez de destruirlos y crearlos de nuevo
+        self._btn_pool = []
+        self._shown = 0
+        # Dirección -> botón mostrado en el escaneo actual
+        self._buttons = {}
+        self._scan_id = 0
+        self._scan_future = None
 
-    def _scan(self):
-        loop = asyncio.new_event_loop()
-        devices = loop.run_until_complete(BleakScanner.discover(timeout=4.0))
-        loop.close()
-        self.after(0, lambda: self._show(devices))
+        self.start_scan()
+
+    def show(self):
+        self.deiconify()
+        self.grab_set()
+        self.start_scan()
 
-    def _show(self, devices):
+    def start_scan(self):
+        # Si el escaneo anterior sigue corriendo, seguimos mostrando sus resultados
+        if self._scan_future and not self._scan_future.done():
+            return
+        self._scan_id += 1
+        sid = self._scan_id
+        for btn in self._btn_pool[:self._shown]:
+            btn.pack_forget()
+        self._shown = 0
+        self._buttons = {}
+        self.lbl.configure(text="Escaneando dispositivos BLE...")
+
+        # El Hub en pausa sigue conectado y no anuncia: lo mostramos primero
+        paused = self.worker.paused_device
+        if paused:
+            self._add_device(sid, *paused)
+
+        # El escaneo corre en el loop del worker; cada Hub (y su nombre, si llega después)
+        # vuelve a Tk con after() apenas aparece
+        self._scan_future = self.worker.submit(self.worker.scan(
+            lambda dev, name: self.after(0, self._add_device, sid, dev, name),
+            lambda dev, name: self.after(0, self._patch_button_text, sid, dev, name),
+        ))
+        # exception() y no result(): un error del escaneo (adaptador apagado, BleakError...)
+        # se perdería dentro del callback y la ventana quedaría "Escaneando..." para siempre
+        self._scan_future.add_done_callback(lambda f: self.after(0, self._scan_done, sid, f.exception()))
+
+    @staticmethod
+    def _device_text(d, name):
+        return f"{name or 'Hub Pybricks'}\n[{d.address}]"
+
+    def _add_device(self, sid, d, name):
+        # Resultado de un escaneo anterior que llegó tarde
+        if sid != self._scan_id or d.address in self._buttons:
+            return
+        # El escáner ya solo entrega Hubs Pybricks
         self.lbl.configure(text="Seleccione su dispositivo:")
-        found = False
-        for d in devices:
-            if d.name and d.name != "Unknown":
-                found = True
-                btn = ctk.CTkButton(
-                    self.scroll,
-                    text=f"{d.name}\n[{d.address}]",
-                    command=lambda dev=d: self._select(dev),
-                    height=40,
-                    fg_color="#1F6AA5"
-                )
-                btn.pack(pady=5, fill="x")
-        
-        if not found:
+        text = self._device_text(d, name)
+        if self._shown < len(self._btn_pool):
+            btn = self._btn_pool[self._shown]
+            btn.configure(text=text, command=partial(self._select, d, name))
+        else:
+            btn = ctk.CTkButton(
+                self.scroll,
+                text=text,
+                command=partial(self._select, d, name),
+                height=40,
+                fg_color="#1F6AA5"
+            )
+            self._btn_pool.append(btn)
+        btn.pack(pady=5, fill="x")
+        self._buttons[d.address] = btn
+        self._shown += 1
+
+    def _patch_button_text(self, sid, d, name):
+        btn = self._buttons.get(d.address)
+        if sid == self._scan_id and btn is not None:
+            btn.configure(text=self._device_text(d, name), command=partial(self._select, d, name))
+
+    def _scan_done(self, sid, error):
+        if sid != self._scan_id:
+            return
+        if error:
+            self.lbl.configure(text=f"Error al escanear: {error}")
+        elif not self._shown:
             self.lbl.configure(text="No se encontraron Hubs.")
 
-    def _select(self, device):
-        self.callback(device)
-        self.destroy()
+    def _hide(self):
+        self.grab_release()
+        self.withdraw()
+
+    def _select(self, device, name):
+        self.callback(device, name)
+        self._hide()
 
 # ==========================================
 # 4. GUI PRINCIPAL 
@@ -245,6 +672,9 @@ class LegoNitroGUI:
     COLOR_BTN_ACTIVE = "#144870"
     COLOR_TURBO_NORMAL = "#D32F2F"
     COLOR_TURBO_ACTIVE = "#8E0000"
+
+    # Tecla -> comando del robot
+    _KEY_CMD = {"Up": "F", "Down": "B", "Left": "L", "Right": "R", "Return": "T", "space": "C"}
     # ---------------------
     def __init__(self, root):
         self.root = root
@@ -253,17 +683,19 @@ class LegoNitroGUI:
 
         # Variables de estado
         self.keys_pressed = set()
-        self.log_queue = Queue()
+        self._selector = None
+        # Último estado aplicado a los botones de control (ver set_controls_enabled)
+        self._controls_state = None
+        # deque: append/popleft son atómicos con el GIL, sin lock (un productor, un consumidor)
+        self.log_queue = deque()
+        self._drain_scheduled = False
         
-        # Iniciar Worker
-        self.worker = BLEWorker(self.log_queue)
-        self.worker.start()
+        # Iniciar Worker (nos avisa cuando hay logs nuevos: no hace falta sondear)
+        self.worker = BLEWorker(self.log_queue, on_log=self._wake_logs)
 
         # Construir Interfaz
         self._build_ui()
-        
-        # Iniciar loop de logs
-        self._poll_logs()
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
 
     def _build_ui(self):
         # --- PANEL SUPERIOR (Conexión) ---
@@ -299,8 +731,8 @@ class LegoNitroGUI:
         )
         self.btn_turbo.grid(row=0, column=1, pady=(20, 10), sticky="ew")
         # Eventos Press/Release para Turbo
-        self.btn_turbo.bind("<ButtonPress-1>", lambda e: self.worker.send_command("T"))
-        self.btn_turbo.bind("<ButtonRelease-1>", lambda e: self.worker.send_command("S"))
+        self.btn_turbo.bind("<ButtonPress-1>", partial(self._press, "T"))
+        self.btn_turbo.bind("<ButtonRelease-1>", self._release_stop)
 
         # Botones de Dirección
         # Avanzar
@@ -310,7 +742,7 @@ class LegoNitroGUI:
         self.btn_izq = self.create_momentary_btn("◀ IZQ", "L", 2, 0)
         
         # Botón Centro (Es de un solo click, no momentary)
-        self.btn_centro = ctk.CTkButton(self.control_frame, text="● CENTRAR", command=lambda: self.worker.send_command("C"), height=40)
+        self.btn_centro = ctk.CTkButton(self.control_frame, text="● CENTRAR", command=partial(self.worker.send_command, "C"), height=40)
         self.btn_centro.grid(row=2, column=1, padx=5, pady=5)
         
         self.btn_der = self.create_momentary_btn("DER ▶", "R", 2, 2)
@@ -327,6 +759,16 @@ class LegoNitroGUI:
         self.log_box.pack(fill="x", padx=5, pady=5)
         self.log_box.configure(state="disabled")
 
+        # Tecla -> (botón, color normal, color activo) para el feedback visual
+        self._KEY_BTN = {
+            "Up": (self.btn_avanzar, self.COLOR_BTN_NORMAL, self.COLOR_BTN_ACTIVE),
+            "Down": (self.btn_retro, self.COLOR_BTN_NORMAL, self.COLOR_BTN_ACTIVE),
+            "Left": (self.btn_izq, self.COLOR_BTN_NORMAL, self.COLOR_BTN_ACTIVE),
+            "Right": (self.btn_der, self.COLOR_BTN_NORMAL, self.COLOR_BTN_ACTIVE),
+            "Return": (self.btn_turbo, self.COLOR_TURBO_NORMAL, self.COLOR_TURBO_ACTIVE),
+            "space": (self.btn_centro, self.COLOR_BTN_NORMAL, self.COLOR_BTN_ACTIVE),
+        }
+
         # Configurar estado inicial (bloqueado)
         self.set_controls_enabled(False)
 
@@ -340,23 +782,34 @@ class LegoNitroGUI:
         btn.grid(row=r, column=c, padx=5, pady=5, sticky="ew")
         
         # Vincular eventos de mouse
-        btn.bind("<ButtonPress-1>", lambda e: self.worker.send_command(cmd_char))
-        btn.bind("<ButtonRelease-1>", lambda e: self.worker.send_command("S"))
+        btn.bind("<ButtonPress-1>", partial(self._press, cmd_char))
+        btn.bind("<ButtonRelease-1>", self._release_stop)
         return btn
 
+    def _press(self, char, e):
+        self.worker.send_command(char)
+
+    def _release_stop(self, e):
+        self.worker.send_command("S")
+
     def set_controls_enabled(self, enabled: bool):
         """Habilita o deshabilita los botones de control visuales"""
         state = "normal" if enabled else "disabled"
-        
-        # Lista de botones a controlar
-        control_buttons = [
-            self.btn_turbo, self.btn_avanzar, self.btn_retro,
-            self.btn_izq, self.btn_der, self.btn_centro
-        ]
-        
-        for btn in control_buttons:
-            btn.configure(state=state)
-            
+
+        # Cada configure() cruza a Tcl: los seis botones solo se tocan si su estado cambia.
+        # La etiqueta de estado sí se aplica siempre (puede haber quedado en "CONECTANDO...")
+        if state != self._controls_state:
+            self._controls_state = state
+
+            # Lista de botones a controlar
+            control_buttons = [
+                self.btn_turbo, self.btn_avanzar, self.btn_retro,
+                self.btn_izq, self.btn_der, self.btn_centro
+            ]
+
+            for btn in control_buttons:
+                btn.configure(state=state)
+
         if enabled:
             self.btn_connect.configure(state="disabled")
             self.btn_disconnect.configure(state="normal")
@@ -367,17 +820,38 @@ class LegoNitroGUI:
             self.status_lbl.configure(text="● DESCONECTADO", text_color="red")
 
     def open_selector(self):
-        DeviceSelectWindow(self.root, self.on_device_selected)
+        # La ventana de búsqueda se crea una sola vez y luego solo se vuelve a mostrar
+        if self._selector is None or not self._selector.winfo_exists():
+            self._selector = DeviceSelectWindow(self.root, self.worker, self.on_device_selected)
+        else:
+            self._selector.show()
 
-    def on_device_selected(self, device):
-        self.log_to_gui(f"Dispositivo seleccionado: {device.name}")
+    def on_device_selected(self, device, name):
+        self.log_to_gui(f"Dispositivo seleccionado: {name or device.address}")
         self.status_lbl.configure(text="CONECTANDO...", text_color="orange")
-        self.worker.connect_to_device(device)
+        ready = self.worker.connect_to_device(device, name)
+        if ready:
+            # Se resuelve en el hilo BLE: volvemos al hilo de Tk con after()
+            # (cancelado = la app se está cerrando, ver BLEWorker.shutdown)
+            ready.add_done_callback(
+                lambda f: f.cancelled() or self.root.after(0, self._on_connected, f.result())
+            )
+
+    def _on_connected(self, ok):
+        # La sesión pudo cerrarse entre medio: se confirma con el estado actual del worker
+        if ok and self.worker.connected:
+            self.set_controls_enabled(True)
 
     def on_disconnect(self):
-        self.worker.stop_connection()
+        # Solo se libera el control: el enlace BLE queda abierto un rato para reconectar al instante
+        self.worker.pause()
         self.set_controls_enabled(False)
 
+    def on_close(self):
+        # Al cerrar la app sí se corta la conexión (el Hub recibe 'X' y detiene el gateway)
+        self.worker.shutdown()
+        self.root.destroy()
+
     # --- Lógica de Teclado ---
     def _on_key_press(self, e):
         # Evitar repetición automática de teclas
@@ -385,66 +859,64 @@ class LegoNitroGUI:
             return
         self.keys_pressed.add(e.keysym)
 
-        if not self.worker.running.is_set(): return
+        if not self.worker.connected: return
         
         # --- NUEVA SECCIÓN VISUAL (Prender luz) ---
-        if e.keysym == "Up": self.btn_avanzar.configure(fg_color=self.COLOR_BTN_ACTIVE)
-        elif e.keysym == "Down": self.btn_retro.configure(fg_color=self.COLOR_BTN_ACTIVE)
-        elif e.keysym == "Left": self.btn_izq.configure(fg_color=self.COLOR_BTN_ACTIVE)
-        elif e.keysym == "Right": self.btn_der.configure(fg_color=self.COLOR_BTN_ACTIVE)
-        elif e.keysym == "Return": self.btn_turbo.configure(fg_color=self.COLOR_TURBO_ACTIVE)
-        elif e.keysym == "space": self.btn_centro.configure(fg_color=self.COLOR_BTN_ACTIVE)
+        btn, _, active = self._KEY_BTN.get(e.keysym, (None, None, None))
+        if btn: btn.configure(fg_color=active)
         # ------------------------------------------
 
-        # Lógica de envío al robot (Igual que antes)...
-        if e.keysym == "Up": self.worker.send_command("F")
-        elif e.keysym == "Down": self.worker.send_command("B")
-        elif e.keysym == "Left": self.worker.send_command("L")
-        elif e.keysym == "Right": self.worker.send_command("R")
-        elif e.keysym == "Return": self.worker.send_command("T")
-        elif e.keysym == "space": self.worker.send_command("C")
+        # Lógica de envío al robot
+        cmd = self._KEY_CMD.get(e.keysym)
+        if cmd: self.worker.send_command(cmd)
 
     def _on_key_release(self, e):
         self.keys_pressed.discard(e.keysym)
-        if not self.worker.running.is_set(): return
+        if not self.worker.connected: return
 
         # Soltar Acelerador -> Stop Tracción ('S')
         if e.keysym in ("Up", "Down", "Return"):
             self.worker.send_command("S")
         
         # --- NUEVA SECCIÓN VISUAL (Apagar luz) ---
-        if e.keysym == "Up": self.btn_avanzar.configure(fg_color=self.COLOR_BTN_NORMAL)
-        elif e.keysym == "Down": self.btn_retro.configure(fg_color=self.COLOR_BTN_NORMAL)
-        elif e.keysym == "Left": self.btn_izq.configure(fg_color=self.COLOR_BTN_NORMAL)
-        elif e.keysym == "Right": self.btn_der.configure(fg_color=self.COLOR_BTN_NORMAL)
-        elif e.keysym == "Return": self.btn_turbo.configure(fg_color=self.COLOR_TURBO_NORMAL)
-        elif e.keysym == "space": self.btn_centro.configure(fg_color=self.COLOR_BTN_NORMAL)
+        btn, normal, _ = self._KEY_BTN.get(e.keysym, (None, None, None))
+        if btn: btn.configure(fg_color=normal)
         # -----------------------------------------
 
 
     # --- Lógica de Logs ---
     def log_to_gui(self, msg):
-        self.log_box.configure(state="normal")
-        self.log_box.insert("end", f"> {msg}\n")
-        self.log_box.see("end")
-        self.log_box.configure(state="disabled")
-
-    def _poll_logs(self):
-        try:
-            while True:
-                msg = self.log_queue.get_nowait()
-                self.log_to_gui(msg)
-                
-                # Detectar mensaje de éxito para habilitar controles
-                if "¡CONEXIÓN ESTABLECIDA!" in msg:
-                    self.set_controls_enabled(True)
-                # Detectar desconexión
-                if "Sistema Desconectado" in msg:
-                    self.set_controls_enabled(False)
-                    
-        except Empty:
-            pass
-        self.root.after(100, self._poll_logs)
+        # Mismo camino que los logs del worker: se escriben juntos en el próximo vaciado
+        self.log_queue.append(("log", msg))
+        self._wake_logs()
+
+    def _wake_logs(self):
+        # Llamado desde otros hilos: agenda un solo vaciado en el hilo de Tk
+        if not self._drain_scheduled:
+            self._drain_scheduled = True
+            self.root.after(0, self._drain_logs)
+
+    def _drain_logs(self):
+        # Se baja la bandera antes de leer: un mensaje que llegue ahora agenda otro vaciado
+        self._drain_scheduled = False
+        # Vaciamos toda la cola y escribimos en el textbox de una sola vez
+        msgs = []
+        while True:
+            try:
+                msgs.append(self.log_queue.popleft())
+            except IndexError:
+                break
+
+        if msgs:
+            text = "> " + "\n> ".join(m for _, m in msgs) + "\n"
+            self.log_box.configure(state="normal")
+            self.log_box.insert("end", text)
+            self.log_box.see("end")
+            self.log_box.configure(state="disabled")
+
+            # Desconexión: la conexión se avisa por el Future de connect_to_device
+            if any(kind == "disconnected" for kind, _ in msgs):
+                self.set_controls_enabled(False)
 
 if __name__ == "__main__":
     ctk.set_appearance_mode("dark")